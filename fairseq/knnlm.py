@@ -204,7 +204,7 @@ class KNN_Dstore(object):
         return dists, knns
 
     def get_knn_log_prob(self, queries, tgt, pad_idx, sample_ids=None, task=None,
-                         lm_probs=None, calc_vocab_prob=False):
+                         lm_probs=None, calc_vocab_prob=False, batch_first=False):
         def dist_func(d, k, q, function=None):
             if not function:
                 # Default behavior for L2 metric is to recompute distances.
@@ -234,6 +234,11 @@ class KNN_Dstore(object):
         qshape = queries.shape
         queries = queries.view(-1, qshape[-1])
 
+        # tgt and lm_probs are BxT if batch_first, TxB otherwise
+        if batch_first:
+            tgt = tgt.t()
+            lm_probs = lm_probs.t()
+
         self.original_tgts.append(tgt)
 
         tgt = tgt.contiguous().view(-1)
@@ -352,8 +357,7 @@ class KNN_Dstore(object):
 
         # (T_reducedxB)
         yhat_knn_prob = torch.logsumexp(probs + index_mask, dim=-1).clone()
-        full_yhat_knn_prob = torch.full([qshape[0] * qshape[1]], -10000.).cuda()
-        full_yhat_knn_prob[tgt != pad_idx] = yhat_knn_prob
+        full_yhat_knn_prob = self.scatter_to_full(yhat_knn_prob.unsqueeze(-1), tgt != pad_idx, qshape, batch_first)
 
         if calc_vocab_prob:
             # calc all vocab item
@@ -368,11 +372,22 @@ class KNN_Dstore(object):
                 mask[mask == 1] = 0
                 yhat_knn_token_prob[i, unique_token_ids] = torch.logsumexp(probs[i].repeat(unique_token_ids.shape[0], 1)
                                                                            + mask, dim=-1).clone()
-            full_yhat_knn_token_prob = torch.full([qshape[0] * qshape[1], vocab_size], -10000.).cuda()
-            full_yhat_knn_token_prob[pad_mask] = yhat_knn_token_prob
+            full_yhat_knn_token_prob = self.scatter_to_full(yhat_knn_token_prob, pad_mask, qshape, batch_first)
 
-            # TxBx1
-            return full_yhat_knn_prob.view(qshape[0], qshape[1], 1), full_yhat_knn_token_prob.view(qshape[0], qshape[1], vocab_size)
+            # TxBx1 and TxBxV (BxTx1 and BxTxV if batch_first)
+            return full_yhat_knn_prob, full_yhat_knn_token_prob
+        else:
+            # TxBx1 (BxTx1 if batch_first)
+            return full_yhat_knn_prob, None
+
+    def scatter_to_full(self, values, pad_mask, qshape, batch_first=False):
+        # values are (T_reducedxB)x?, one row per non-pad token in TxB order
+        # writing through a transposed view lays the result out as BxTx? directly
+        tsz, bsz = qshape[0], qshape[1]
+        if batch_first:
+            full = torch.full([bsz, tsz, values.size(-1)], -10000., device=values.device)
+            full.transpose(0, 1)[pad_mask.view(tsz, bsz)] = values
         else:
-            # TxBx1
-            return full_yhat_knn_prob.view(qshape[0], qshape[1], 1), None
+            full = torch.full([tsz, bsz, values.size(-1)], -10000., device=values.device)
+            full[pad_mask.view(tsz, bsz)] = values
+        return full
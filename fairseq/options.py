@@ -491,6 +491,9 @@ def add_eval_lm_args(parser):
                        help='save keys for the knnlm datastore')
     group.add_argument('--dstore-mmap', default=None, type=str,
                        help='If saving knnlm dstore, save keys and values to this file')
+    group.add_argument('--torch-compile', action='store_true',
+                       help='compile the scoring ops with torch.compile (torch>=2.0), '
+                            'falling back to eager mode where it is not supported')
     # fmt: on
 
 
@@ -3,16 +3,96 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import logging
+import math
+
 import torch
 import sys
-import numpy as np
 import time
 
 from fairseq import utils
 from fairseq.data import Dictionary
+from fairseq.models import BaseFairseqModel, FairseqDecoder
 from fairseq.utils import get_mrr
 
 
+logger = logging.getLogger(__name__)
+
+
+def compile_or_eager(fn, **compiled_kwargs):
+    """Wraps *fn* with torch.compile, falling back to running it eagerly.
+
+    torch.compile fuses the pointwise and reduction ops of the scoring helpers
+    below into a few kernels, but it is not available everywhere (torch<2.0,
+    unsupported Python versions or platforms) and can fail on the first call
+    (e.g. GPUs without Triton support), in which case we keep scoring eagerly.
+    *compiled_kwargs* override the keyword arguments of the compiled calls only.
+    """
+    try:
+        import torch._dynamo
+        if not torch._dynamo.is_dynamo_supported():
+            raise RuntimeError('dynamo is not supported on this platform')
+        compiled = torch.compile(fn, dynamic=True)
+        compile_errors = torch._dynamo.exc.TorchDynamoException
+    except Exception as e:
+        logger.warning('cannot compile {} ({}), running it eagerly'.format(fn.__name__, e))
+        return fn
+
+    def wrapper(*args, **kwargs):
+        if wrapper.compiled is not None:
+            try:
+                return wrapper.compiled(*args, **{**kwargs, **compiled_kwargs})
+            except compile_errors as e:
+                # anything else (e.g. OOMs) is not a compilation failure, and
+                # would just happen again when running eagerly
+                logger.warning('compiling {} failed ({}), running it eagerly'.format(fn.__name__, e))
+                wrapper.compiled = None
+        return fn(*args, **kwargs)
+
+    wrapper.compiled = compiled
+    return wrapper
+
+
+# upper bound on the number of logits upcast to fp32 at once by score_logits
+LOGSUMEXP_CHUNK_NUMEL = 2 ** 24
+
+
+def score_logits(logits, target, k, chunk_numel=LOGSUMEXP_CHUNK_NUMEL):
+    """Target log probs and top-k tokens of a softmax batch, from its logits.
+
+    Same as a log_softmax followed by a gather, but without materializing the
+    normalized distribution over the vocab; log_softmax is monotonic, so the
+    top-k can be read off the logits directly. Only the gathered logits and
+    the logsumexp are computed in fp32, the latter over at most *chunk_numel*
+    logits at a time (all at once if None, which lets torch.compile fuse the
+    upcast into the reduction), so fp16 logits are never upcast as a whole.
+    """
+    tgt_logits = logits.gather(dim=2, index=target.unsqueeze(-1)).float()
+    flat = logits.reshape(-1, logits.size(-1))
+    if chunk_numel is None:
+        lse = torch.logsumexp(flat.float(), dim=-1)
+    else:
+        chunk_rows = max(1, chunk_numel // flat.size(-1))
+        lse = torch.cat([torch.logsumexp(chunk.float(), dim=-1) for chunk in flat.split(chunk_rows)])
+    tgt_probs = tgt_logits - lse.view(tgt_logits.shape)
+    if k == 0:
+        return tgt_probs, None
+    _, topk_tokens = torch.topk(logits, k=k, dim=-1)
+    return tgt_probs, topk_tokens
+
+
+def combine_knn_and_vocab_probs(knn_p, vocab_p, log_lmbda, log_one_minus_lmbda, dtype):
+    # casting here lets the cast fuse with the interpolation
+    return torch.logaddexp(vocab_p.to(dtype) + log_one_minus_lmbda, knn_p.to(dtype) + log_lmbda)
+
+
+def combine_knn_and_vocab_topk(knn_p, vocab_p, log_lmbda, log_one_minus_lmbda, k):
+    """Top-k tokens of the interpolated kNN and vocab distributions."""
+    combine_probs = torch.logaddexp(vocab_p + log_one_minus_lmbda, knn_p + log_lmbda)
+    _, topk_tokens = torch.topk(combine_probs, k=k, dim=-1)
+    return topk_tokens
+
+
 class SequenceScorer(object):
     """Scores the target for a given source sentence."""
 
@@ -23,8 +103,39 @@ class SequenceScorer(object):
         assert self.softmax_batch > 0
         self.compute_alignment = compute_alignment
         self.args = args
-        if self.args.save_top_pred:
+        # number of predicted tokens kept per position, only computed when
+        # the predictions are saved or analysed
+        self.topk = 100
+        self.need_topk = getattr(args, 'save_top_pred', False) or getattr(args, 'knnlm', False)
+        # scratch space for the full vocab distribution, reused across batches
+        self._full_probs_buf = None
+        # compiling the scoring helpers is opt-in, see compile_or_eager
+        if getattr(args, 'torch_compile', False):
+            # the compiled logsumexp fuses the upcast, so it needs no chunking
+            self._score_logits = compile_or_eager(score_logits, chunk_numel=None)
+            self._combine_knn_and_vocab_probs = compile_or_eager(combine_knn_and_vocab_probs)
+            self._combine_knn_and_vocab_topk = compile_or_eager(combine_knn_and_vocab_topk)
+        else:
+            self._score_logits = score_logits
+            self._combine_knn_and_vocab_probs = combine_knn_and_vocab_probs
+            self._combine_knn_and_vocab_topk = combine_knn_and_vocab_topk
+        if getattr(args, 'save_top_pred', False):
             self.top_preds = []
+        if getattr(args, 'knnlm', False):
+            # lmbda is fixed for the whole run, so take its logs once here
+            # (np.log semantics: log(0) is -inf rather than an error)
+            self._log_lmbda = math.log(args.lmbda) if args.lmbda > 0 else -math.inf
+            self._log_one_minus_lmbda = math.log1p(-args.lmbda) if args.lmbda < 1 else -math.inf
+
+    def _get_full_probs_buf(self, like, size):
+        # only grow the buffer when a batch needs more room, so that the caching
+        # allocator does not see a new BxTxV allocation every batch
+        numel = size.numel()
+        buf = self._full_probs_buf
+        if buf is None or buf.numel() < numel or buf.dtype != like.dtype or buf.device != like.device:
+            self._full_probs_buf = buf = None
+            self._full_probs_buf = buf = like.new(numel)
+        return buf[:numel].view(size)
 
     @torch.no_grad()
     def generate(self, models, sample, **kwargs):
@@ -53,14 +164,19 @@ class SequenceScorer(object):
             )
             return probs
 
-        def combine_knn_and_vocab_probs(knn_p, vocab_p, coeff):
-            combine_probs = torch.stack([vocab_p, knn_p], dim=0)
-            coeffs = torch.ones_like(combine_probs)
-            coeffs[0] = np.log(1 - coeff)
-            coeffs[1] = np.log(coeff)
-            curr_prob = torch.logsumexp(combine_probs + coeffs, dim=0)
+        def normalizes_logits(model):
+            # True if the model's probs are a plain softmax over decoder_out[0]
+            decoder = getattr(model, 'decoder', None)
+            return (
+                type(model).get_normalized_probs is BaseFairseqModel.get_normalized_probs
+                and isinstance(decoder, FairseqDecoder)
+                and type(decoder).get_normalized_probs is FairseqDecoder.get_normalized_probs
+                and getattr(decoder, 'adaptive_softmax', None) is None
+            )
 
-            return curr_prob
+        def get_topk_tokens(probs):
+            _, topk_tokens = torch.topk(probs, k=min(self.topk, probs.size(-1)), dim=-1)
+            return topk_tokens
 
         orig_target = sample['target']
 
@@ -74,34 +190,65 @@ class SequenceScorer(object):
             if type(attn) is dict:
                 attn = attn.get('attn', None)
             batched = batch_for_softmax(decoder_out, orig_target)
+            # the full vocab distribution is only needed for the top-k of its
+            # interpolation with the datastore (--knnlm always saves the top-k);
+            # otherwise we just keep the top-k of every softmax batch, if any
+            need_full = 'knn_dstore' in kwargs
+            # without a datastore the top-k can be read off the logits directly,
+            # since log_softmax is monotonic
+            use_logits = not need_full and normalizes_logits(model)
             probs, idx = None, 0
             full_probs = None
+            topk_tokens = None
             for i, (bd, tgt, is_single) in enumerate(batched):
-                sample['target'] = tgt
-                curr_prob = model.get_normalized_probs(bd, log_probs=len(models) == 1, sample=sample).data
+                if use_logits:
+                    tgt_probs, curr_topk = self._score_logits(
+                        bd[0], tgt, min(self.topk, bd[0].size(-1)) if self.need_topk else 0)
+                    if len(models) != 1:
+                        tgt_probs.exp_()
+                else:
+                    # only adaptive softmax reads the target; hand it this batch's
+                    # target without mutating the shared sample
+                    curr_prob = model.get_normalized_probs(
+                        bd, log_probs=len(models) == 1, sample={**sample, 'target': tgt}).data
+                    tgt_probs = gather_target_probs(curr_prob, tgt)
+                    if not need_full and self.need_topk:
+                        curr_topk = get_topk_tokens(curr_prob)
 
                 if is_single:
-                    probs = gather_target_probs(curr_prob, orig_target)
-                    full_probs = curr_prob
+                    probs = tgt_probs
+                    if need_full:
+                        # only read from here on, so aliasing the model's output is safe
+                        full_probs = curr_prob
+                    elif self.need_topk:
+                        topk_tokens = curr_topk
                 else:
                     if probs is None:
-                        probs = curr_prob.new(orig_target.numel())
-                    if full_probs is None:
-                        full_probs = curr_prob.new(
-                            torch.Size([curr_prob.size(0), orig_target.numel(), curr_prob.size(2)]))
-                    step = curr_prob.size(0) * curr_prob.size(1)
+                        probs = tgt_probs.new(orig_target.numel())
+                    step = tgt_probs.size(0) * tgt_probs.size(1)
                     end = step + idx
-                    full_probs[:, idx:end, :] = curr_prob
-                    tgt_probs = gather_target_probs(curr_prob.view(tgt.shape + (curr_prob.size(-1),)), tgt)
+                    if need_full:
+                        if full_probs is None:
+                            full_probs = self._get_full_probs_buf(
+                                curr_prob, torch.Size([curr_prob.size(0), orig_target.numel(), curr_prob.size(2)]))
+                        full_probs[:, idx:end, :] = curr_prob
+                    elif self.need_topk:
+                        if topk_tokens is None:
+                            topk_tokens = curr_topk.new(
+                                torch.Size([curr_topk.size(0), orig_target.numel(), curr_topk.size(2)]))
+                        topk_tokens[:, idx:end, :] = curr_topk
                     probs[idx:end] = tgt_probs.view(-1)
                     idx = end
-                sample['target'] = orig_target
-            full_probs[full_probs == 0.] = -1e4
 
             # if self.args.save_top_pred and len(models) == 1:
             #     self.top_preds.append()
             probs = probs.view(sample['target'].shape)
-            full_probs = full_probs.squeeze(0).view(sample['target'].shape[0], sample['target'].shape[1], -1)
+            if need_full:
+                # padded positions are left as is: softmax batches cover every
+                # token, and the top-k of pads is sliced off with the padding below
+                full_probs = full_probs.squeeze(0).view(sample['target'].shape[0], sample['target'].shape[1], -1)
+            elif self.need_topk:
+                topk_tokens = topk_tokens.view(sample['target'].shape[0], sample['target'].shape[1], -1)
 
             if 'knn_dstore' in kwargs:
                 dstore = kwargs['knn_dstore']
@@ -123,27 +270,32 @@ class SequenceScorer(object):
 
                 yhat_knn_prob, yhat_knn_vocab_prob = dstore.get_knn_log_prob(
                     queries,
-                    orig_target.permute(1, 0),
+                    orig_target,
                     sample_ids=sample['id'],
                     pad_idx=self.pad,
                     task=kwargs['task'],
-                    lm_probs=probs.permute(1, 0),
-                    calc_vocab_prob=True)
+                    lm_probs=probs,
+                    calc_vocab_prob=True,
+                    batch_first=True)
 
-                yhat_knn_prob = yhat_knn_prob.permute(1, 0, 2).squeeze(-1)
-                yhat_knn_vocab_prob = yhat_knn_vocab_prob.permute(1, 0, 2)
+                yhat_knn_prob = yhat_knn_prob.squeeze(-1)
 
-                # yhat_knn_vocab_prob = yhat_knn_vocab_prob.permute(1, 0, 2)
-                if self.args.fp16:
-                    yhat_knn_prob = yhat_knn_prob.half()
-                    if yhat_knn_vocab_prob is not None:
-                        yhat_knn_vocab_prob = yhat_knn_vocab_prob.half()
-                    probs = probs.half()
+                probs = self._combine_knn_and_vocab_probs(
+                    yhat_knn_prob, probs, self._log_lmbda, self._log_one_minus_lmbda,
+                    torch.half if self.args.fp16 else probs.dtype)
 
-                probs = combine_knn_and_vocab_probs(
-                    yhat_knn_prob, probs, self.args.lmbda)
-
-                full_probs = combine_knn_and_vocab_probs(yhat_knn_vocab_prob, full_probs, self.args.lmbda)
+                # the interpolated distribution is only needed for its top-k, so
+                # build it one softmax batch worth of time steps at a time (in
+                # fp32, which the datastore's vocab probs promote it to)
+                bsz, tsz = orig_target.size()
+                step = max(1, min(self.softmax_batch // bsz, tsz))
+                for s in range(0, tsz, step):
+                    curr_topk = self._combine_knn_and_vocab_topk(
+                        yhat_knn_vocab_prob[:, s:s + step], full_probs[:, s:s + step],
+                        self._log_lmbda, self._log_one_minus_lmbda, min(self.topk, full_probs.size(-1)))
+                    if topk_tokens is None:
+                        topk_tokens = curr_topk.new(torch.Size([bsz, tsz, curr_topk.size(2)]))
+                    topk_tokens[:, s:s + step] = curr_topk
 
                 # _, after_topk = torch.topk(vocab_probs, k=10, dim=-1)
 
@@ -163,20 +315,32 @@ class SequenceScorer(object):
             if avg_attn is not None:
                 avg_attn.div_(len(models))
 
-        _, topk_tokens = torch.topk(full_probs, k=100, dim=-1)
-
-        bsz = avg_probs.size(0)
+        bsz, tsz = avg_probs.size()
         hypos = []
         start_idxs = sample['start_indices'] if 'start_indices' in sample else [0] * bsz
-        for i in range(bsz):
+        # reduce every example at once and bring the lengths and scores to the
+        # host in one transfer each, instead of a few small kernels per example
+        # (padding only trails the targets, as the slicing below assumes)
+        tgt_mask = sample['target'].ne(self.pad)
+        if any(start_idxs):
+            # only LMContextWindowDataset sets non-zero start indices
+            positions = torch.arange(tsz, device=avg_probs.device)
+            tgt_mask &= positions.ge(positions.new_tensor(start_idxs).unsqueeze(1))
+        tgt_lens = tgt_mask.sum(1)
+        # in fp32, fp16 is not exact for lengths above 2048
+        scores = (avg_probs.float().masked_fill(~tgt_mask, 0).sum(1) / tgt_lens.float()).cpu()
+        if topk_tokens is not None:
+            # the predictions are only ever accumulated on the host (eval_lm keeps
+            # them for prediction.pt), so don't keep every batch's copy on the GPU
+            topk_tokens = topk_tokens.cpu()
+        spans = [slice(start, start + tgt_len) for start, tgt_len in zip(start_idxs, tgt_lens.tolist())]
+        for i, span in enumerate(spans):
             # remove padding from ref
-            ref = utils.strip_pad(sample['target'][i, start_idxs[i]:], self.pad) \
-                if sample['target'] is not None else None
-            tgt_len = ref.numel()
-            avg_probs_i = avg_probs[i][start_idxs[i]:start_idxs[i] + tgt_len]
-            score_i = avg_probs_i.sum() / tgt_len
+            ref = sample['target'][i, span]
+            avg_probs_i = avg_probs[i, span]
+            score_i = scores[i]
 
-            topk_tokens_i = topk_tokens[i][start_idxs[i]:start_idxs[i] + tgt_len]
+            topk_tokens_i = topk_tokens[i, span] if topk_tokens is not None else None
 
             # pad_mask = sample['target'][i, start_idxs[i]:] != self.pad
             # original_mrr = get_mrr(original_topk[i][pad_mask], ref)
@@ -203,8 +367,8 @@ class SequenceScorer(object):
                 'attention': avg_attn_i,
                 'alignment': alignment,
                 'positional_scores': avg_probs_i,
-                'dstore_keys': decoder_out[1][self.args.knn_keytype][start_idxs[i]:, i, :]
-                if self.args.save_knnlm_dstore else None,
+                'dstore_keys': decoder_out[1][self.args.knn_keytype][span.start:, i, :]
+                if getattr(self.args, 'save_knnlm_dstore', False) else None,
                 'predicted_topk': topk_tokens_i,
             }])
         return hypos
@@ -55,6 +55,89 @@ class WordStat(object):
                                                self.next_word_prob, self.count - self.missing_next_words)
 
 
+class DstoreWriter(object):
+    def __init__(self, keys, vals, use_cuda, flush_size=65536):
+        """ writes datastore keys and values to their memmaps through two pinned staging buffers. Consecutive
+            samples are copied asynchronously into the current buffer, and a full buffer is written to the
+            memmaps in one block while the other one fills up, so that the device-to-host transfers overlap
+            with the following forward passes and the memmaps only see large sequential writes """
+        self.keys = keys
+        self.vals = vals
+        self.use_cuda = use_cuda
+        self.flush_size = flush_size
+        self.key_dtype = torch.float16 if keys.dtype == np.float16 else torch.float32
+        self.val_dtype = torch.int64
+        self.stage = [None, None]
+        self.slot = 0
+        self.start = 0
+        self.offset = 0
+        self.pending = None
+
+    def _get_stage(self, slot, size):
+        if self.stage[slot] is None or self.stage[slot][0].size(0) < size:
+            size = max(size, self.flush_size)
+            self.stage[slot] = (
+                torch.empty(size, self.keys.shape[1], dtype=self.key_dtype, pin_memory=self.use_cuda),
+                torch.empty(size, 1, dtype=self.val_dtype, pin_memory=self.use_cuda),
+            )
+        return self.stage[slot]
+
+    def write(self, start, keys, vals):
+        size = keys.size(0)
+        if self.offset > 0 and (
+            start != self.start + self.offset
+            or self.offset + size > self.stage[self.slot][0].size(0)
+        ):
+            self._swap()
+        if self.offset == 0:
+            self.start = start
+        key_buf, val_buf = self._get_stage(self.slot, size)
+        # cast and pack on the device, so that only the datastore dtype crosses PCIe (half the bytes for fp16
+        # keys) and no conversion is left for the host
+        key_buf[self.offset:self.offset + size].copy_(keys.to(self.key_dtype).contiguous(), non_blocking=True)
+        val_buf[self.offset:self.offset + size].copy_(vals.to(self.val_dtype).contiguous(), non_blocking=True)
+        self.offset += size
+
+    def flush(self):
+        if self.offset > 0:
+            self._swap()
+        self._write_pending()
+
+    def _swap(self):
+        event = None
+        if self.use_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self._write_pending()
+        self.pending = (self.slot, event, self.start, self.offset)
+        self.slot = 1 - self.slot
+        self.offset = 0
+
+    def _write_pending(self):
+        if self.pending is None:
+            return
+        slot, event, start, size = self.pending
+        if event is not None:
+            event.synchronize()
+        key_buf, val_buf = self.stage[slot]
+        self.keys[start:start + size] = key_buf[:size].numpy()
+        self.vals[start:start + size] = val_buf[:size].numpy()
+        self.pending = None
+
+
+def merge_bpe_scores(tokens, pos_scores, bpe_lut):
+    """ every bpe continuation passes its (accumulated) score on to the next token, so each word's score ends up
+        summed on its last token and the other positions of the word are zeroed. Returns the merged scores and the
+        number of continuations, as a tensor so that counting them does not sync with the device """
+    if tokens.numel() <= 1:
+        return pos_scores, tokens.new_zeros(())
+    is_bpe = bpe_lut[tokens[:-1]]
+    word_end = torch.cat([~is_bpe, is_bpe.new_ones(1)])
+    word_idx = word_end.long().cumsum(0) - word_end.long()
+    word_scores = pos_scores.new_zeros(pos_scores.size()).index_add_(0, word_idx, pos_scores)
+    return word_scores[word_idx].masked_fill_(~word_end, 0), is_bpe.sum()
+
+
 def main(parsed_args):
     assert parsed_args.path is not None, '--path required for evaluation!'
 
@@ -125,8 +208,12 @@ def main(parsed_args):
     gen_timer = StopwatchMeter()
     scorer = SequenceScorer(task.target_dictionary, args.softmax_batch, args=args)
 
-    score_sum = 0.
-    count = 0
+    # accumulated on the device and only synced once, after the last batch
+    score_sum = torch.zeros((), dtype=torch.double)
+    count = torch.zeros((), dtype=torch.long)
+    if use_cuda:
+        score_sum = score_sum.cuda()
+        count = count.cuda()
 
     if args.remove_bpe is not None:
         if args.remove_bpe == 'sentencepiece':
@@ -139,6 +226,11 @@ def main(parsed_args):
                 if task.source_dictionary[i].endswith(bpe_cont)
             }
         bpe_len = len(bpe_cont)
+        # dense lookup table, so that marking bpe continuations is a single gather
+        bpe_lut = torch.zeros(len(task.source_dictionary), dtype=torch.bool)
+        bpe_lut[list(bpe_toks)] = True
+        if use_cuda:
+            bpe_lut = bpe_lut.cuda()
     else:
         bpe_toks = None
         bpe_len = 0
@@ -169,113 +261,110 @@ def main(parsed_args):
                                         shape=(args.dstore_size, args.decoder_embed_dim))
                 dstore_vals = np.memmap(args.dstore_mmap + '_vals.npy', dtype=np.int, mode='w+',
                                         shape=(args.dstore_size, 1))
+            dstore_writer = DstoreWriter(dstore_keys, dstore_vals, use_cuda)
 
         dstore_idx = 0
 
         prediction_save = {'topk': [], 'ref': []}
-        for ex_i, sample in enumerate(t):
-            if 'net_input' not in sample:
-                continue
-
-            # if ex_i > 300:
-            #     continue
-
-            sample = utils.move_to_cuda(sample) if use_cuda else sample
-            gen_timer.start()
-            if args.knnlm:
-                hypos = scorer.generate(models, sample, knn_dstore=knn_dstore, task=task)
-            else:
-                hypos = scorer.generate(models, sample)
-            gen_timer.stop(sample['ntokens'])
-
-            for i, hypos_i in enumerate(hypos):
-                hypo = hypos_i[0]
-                sample_id = sample['id'][i]
-
-                if args.save_knnlm_dstore:
-                    shape = hypo['dstore_keys'].shape
-                    # if shape[0] == args.tokens_per_sample:
-                    if dstore_idx + shape[0] > args.dstore_size:
-                        print("ERROR! dstore_size exceeded!")
-                        shape = [args.dstore_size - dstore_idx]
-                        hypo['dstore_keys'] = hypo['dstore_keys'][:shape[0]]
-                    actual_size = hypo['tokens'].shape[0]
-                    dstore_token_sample_map[sample_id.cpu().item()] = (dstore_idx, actual_size + dstore_idx)
-                    if args.dstore_fp16:
-                        dstore_keys[dstore_idx:actual_size + dstore_idx] = hypo['dstore_keys'][:actual_size, :].view(
-                            -1, args.decoder_embed_dim).cpu().numpy().astype(np.float16)
-                        dstore_vals[dstore_idx:actual_size + dstore_idx] = hypo['tokens'].view(
-                            -1, 1).cpu().numpy().astype(np.int)
-                    else:
-                        dstore_keys[dstore_idx:actual_size + dstore_idx] = hypo['dstore_keys'][:actual_size, :].view(
-                            -1, args.decoder_embed_dim).cpu().numpy().astype(np.float32)
-                        dstore_vals[dstore_idx:actual_size + dstore_idx] = hypo['tokens'].view(
-                            -1, 1).cpu().numpy().astype(np.int)
-
-                    dstore_idx += actual_size
-
-                tokens = hypo['tokens']
-                tgt_len = tokens.numel()
-                pos_scores = hypo['positional_scores'].float()
-                predicted_topk = hypo['predicted_topk']
-
-                prediction_save['topk'].append(predicted_topk)
-                prediction_save['ref'].append(tokens)
-                if args.add_bos_token:
-                    assert hypo['tokens'][0].item() == task.target_dictionary.bos()
-                    tokens = tokens[1:]
-                    pos_scores = pos_scores[1:]
-
-                skipped_toks = 0
-                if bpe_toks is not None:
-                    for i in range(tgt_len - 1):
-                        if tokens[i].item() in bpe_toks:
-                            skipped_toks += 1
-                            pos_scores[i + 1] += pos_scores[i]
-                            pos_scores[i] = 0
-
-                # inf_scores = pos_scores.eq(float('inf')) | pos_scores.eq(float('-inf'))
-                # if inf_scores.any():
-                #    logger.info(
-                #        'skipping tokens with inf scores:',
-                #        task.target_dictionary.string(tokens[inf_scores.nonzero()])
-                #    )
-                #    pos_scores = pos_scores[(~inf_scores).nonzero()]
-                score_sum += pos_scores.sum().cpu()
-                count += pos_scores.numel() - skipped_toks
-
-                if args.output_word_probs or args.output_word_stats:
-                    w = ''
-                    word_prob = []
-                    is_bpe = False
-                    for i in range(len(tokens)):
-                        w_ind = tokens[i].item()
-                        w += task.source_dictionary[w_ind]
-                        if bpe_toks is not None and w_ind in bpe_toks:
-                            w = w[:-bpe_len]
-                            is_bpe = True
-                        else:
-                            word_prob.append((w, pos_scores[i].item()))
-
-                            next_prob = None
-                            ind = i + 1
-                            while ind < len(tokens):
-                                if pos_scores[ind].item() != 0:
-                                    next_prob = pos_scores[ind]
-                                    break
-                                ind += 1
-
-                            word_stats.setdefault(w, WordStat(w, is_bpe)).add(pos_scores[i].item(), next_prob)
-                            is_bpe = False
-                            w = ''
-                    if args.output_word_probs:
-                        logger.info(
-                            str(int(sample_id)) + " "
-                            + ('\t'.join('{} [{:2f}]'.format(x[0], x[1]) for x in word_prob))
+        try:
+            for ex_i, sample in enumerate(t):
+                if 'net_input' not in sample:
+                    continue
+
+                # if ex_i > 300:
+                #     continue
+
+                sample = utils.move_to_cuda(sample) if use_cuda else sample
+                gen_timer.start()
+                if args.knnlm:
+                    hypos = scorer.generate(models, sample, knn_dstore=knn_dstore, task=task)
+                else:
+                    hypos = scorer.generate(models, sample)
+                gen_timer.stop(sample['ntokens'])
+
+                for i, hypos_i in enumerate(hypos):
+                    hypo = hypos_i[0]
+                    sample_id = sample['id'][i]
+
+                    if args.save_knnlm_dstore:
+                        shape = hypo['dstore_keys'].shape
+                        # if shape[0] == args.tokens_per_sample:
+                        if dstore_idx + shape[0] > args.dstore_size:
+                            print("ERROR! dstore_size exceeded!")
+                            shape = [args.dstore_size - dstore_idx]
+                            hypo['dstore_keys'] = hypo['dstore_keys'][:shape[0]]
+                        actual_size = hypo['tokens'].shape[0]
+                        dstore_token_sample_map[sample_id.cpu().item()] = (dstore_idx, actual_size + dstore_idx)
+                        dstore_writer.write(
+                            dstore_idx,
+                            hypo['dstore_keys'][:actual_size, :].view(-1, args.decoder_embed_dim),
+                            hypo['tokens'].view(-1, 1),
                         )
 
-            wps_meter.update(sample['ntokens'])
-            t.log({'wps': round(wps_meter.avg)})
+                        dstore_idx += actual_size
+
+                    tokens = hypo['tokens']
+                    pos_scores = hypo['positional_scores'].float()
+                    if scorer.need_topk:
+                        prediction_save['topk'].append(hypo['predicted_topk'])
+                        prediction_save['ref'].append(tokens)
+                    if args.add_bos_token:
+                        assert hypo['tokens'][0].item() == task.target_dictionary.bos()
+                        tokens = tokens[1:]
+                        pos_scores = pos_scores[1:]
+
+                    skipped_toks = 0
+                    if bpe_toks is not None:
+                        pos_scores, skipped_toks = merge_bpe_scores(tokens, pos_scores, bpe_lut)
+
+                    # inf_scores = pos_scores.eq(float('inf')) | pos_scores.eq(float('-inf'))
+                    # if inf_scores.any():
+                    #    logger.info(
+                    #        'skipping tokens with inf scores:',
+                    #        task.target_dictionary.string(tokens[inf_scores.nonzero()])
+                    #    )
+                    #    pos_scores = pos_scores[(~inf_scores).nonzero()]
+                    score_sum += pos_scores.sum()
+                    count += pos_scores.numel() - skipped_toks
+
+                    if args.output_word_probs or args.output_word_stats:
+                        # move the example to the host once rather than syncing on every token
+                        token_list = tokens.tolist()
+                        score_list = pos_scores.tolist()
+
+                        # first non-zero score after each position, i.e. the prob of the next word
+                        next_probs = [None] * len(score_list)
+                        next_prob = None
+                        for i in range(len(score_list) - 1, -1, -1):
+                            next_probs[i] = next_prob
+                            if score_list[i] != 0:
+                                next_prob = score_list[i]
+
+                        w = ''
+                        word_prob = []
+                        is_bpe = False
+                        for i, w_ind in enumerate(token_list):
+                            w += task.source_dictionary[w_ind]
+                            if bpe_toks is not None and w_ind in bpe_toks:
+                                w = w[:-bpe_len]
+                                is_bpe = True
+                            else:
+                                word_prob.append((w, score_list[i]))
+                                word_stats.setdefault(w, WordStat(w, is_bpe)).add(score_list[i], next_probs[i])
+                                is_bpe = False
+                                w = ''
+                        if args.output_word_probs:
+                            logger.info(
+                                str(int(sample_id)) + " "
+                                + ('\t'.join('{} [{:2f}]'.format(x[0], x[1]) for x in word_prob))
+                            )
+
+                wps_meter.update(sample['ntokens'])
+                t.log({'wps': round(wps_meter.avg)})
+        finally:
+            if args.save_knnlm_dstore:
+                # staged rows only reach the memmaps on a swap, so write them out even if scoring fails midway
+                dstore_writer.flush()
 
     if args.save_knnlm_dstore:
         print("dstore_idx", dstore_idx, "final shape", shape)
@@ -285,6 +374,8 @@ def main(parsed_args):
         print("token sample id mapping size:", len(dstore_token_sample_map))
         torch.save(dstore_token_sample_map, args.dstore_mmap + '_map.pt')
 
+    score_sum = score_sum.item()
+    count = count.item()
     avg_nll_loss = -score_sum / count / math.log(2)  # convert to base 2
     logger.info('Evaluated {} tokens in {:.1f}s ({:.2f} tokens/s)'.format(
         gen_timer.n, gen_timer.sum, 1. / gen_timer.avg
@@ -294,7 +385,8 @@ def main(parsed_args):
     ))
 
     # save prediction result
-    torch.save(prediction_save, 'prediction.pt')
+    if scorer.need_topk:
+        torch.save(prediction_save, 'prediction.pt')
     if args.knnlm:
         dir_name = args.dstore_filename.split('/')[-2]
         if not os.path.exists('saved_tensors/' + dir_name):
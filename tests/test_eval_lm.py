@@ -0,0 +1,129 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq_cli.eval_lm import DstoreWriter, merge_bpe_scores
+
+
+class TestDstoreWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _memmaps(self, name, key_dtype, size, dim):
+        keys = np.memmap(os.path.join(self.tmpdir, name + '_keys.npy'), dtype=key_dtype, mode='w+',
+                         shape=(size, dim))
+        vals = np.memmap(os.path.join(self.tmpdir, name + '_vals.npy'), dtype=np.int64, mode='w+',
+                         shape=(size, 1))
+        return keys, vals
+
+    def _check_round_trip(self, key_dtype, samples, flush_size=4, dim=3):
+        size = max(start + len(keys) for start, keys, _ in samples)
+        keys, vals = self._memmaps('writer', key_dtype, size, dim)
+        ref_keys, ref_vals = self._memmaps('ref', key_dtype, size, dim)
+
+        writer = DstoreWriter(keys, vals, use_cuda=False, flush_size=flush_size)
+        for start, sample_keys, sample_vals in samples:
+            writer.write(start, sample_keys, sample_vals)
+            # the original per-sample writes
+            ref_keys[start:start + len(sample_keys)] = sample_keys.numpy().astype(key_dtype)
+            ref_vals[start:start + len(sample_keys)] = sample_vals.numpy().astype(np.int64)
+        writer.flush()
+
+        np.testing.assert_array_equal(keys, ref_keys)
+        np.testing.assert_array_equal(vals, ref_vals)
+
+    def _samples(self, starts_and_sizes, dim=3):
+        torch.manual_seed(0)
+        return [
+            (start, torch.randn(size, dim), torch.randint(0, 100, (size, 1)))
+            for start, size in starts_and_sizes
+        ]
+
+    def test_round_trip_fp32(self):
+        # fills the buffer exactly, overflows it and exceeds it with a single sample
+        samples = self._samples([(0, 3), (3, 1), (4, 2), (6, 9), (15, 1), (16, 4)])
+        self._check_round_trip(np.float32, samples)
+
+    def test_round_trip_fp16(self):
+        samples = self._samples([(0, 2), (2, 5), (7, 3), (10, 1)])
+        self._check_round_trip(np.float16, samples)
+
+    def test_non_contiguous_samples(self):
+        # a gap or a rewind between samples starts a new block
+        samples = self._samples([(0, 2), (5, 1), (6, 2), (1, 2), (12, 6)])
+        self._check_round_trip(np.float32, samples)
+
+    def test_flush_is_idempotent(self):
+        keys, vals = self._memmaps('writer', np.float32, 4, 3)
+        writer = DstoreWriter(keys, vals, use_cuda=False, flush_size=4)
+        (start, sample_keys, sample_vals), = self._samples([(0, 3)])
+        writer.write(start, sample_keys, sample_vals)
+        writer.flush()
+        writer.flush()
+        np.testing.assert_array_equal(keys[:3], sample_keys.numpy())
+        np.testing.assert_array_equal(vals[:3], sample_vals.numpy())
+
+
+class TestMergeBpeScores(unittest.TestCase):
+
+    vocab_size = 6
+    bpe_toks = {4, 5}  # e.g. 'foo@@' and 'bar@@'
+
+    def _old_merge(self, tokens, pos_scores):
+        # the sequential loop from eval_lm this replaces
+        pos_scores = pos_scores.clone()
+        skipped_toks = 0
+        for i in range(len(tokens) - 1):
+            if tokens[i].item() in self.bpe_toks:
+                skipped_toks += 1
+                pos_scores[i + 1] += pos_scores[i]
+                pos_scores[i] = 0
+        return pos_scores, skipped_toks
+
+    def _check(self, tokens):
+        bpe_lut = torch.zeros(self.vocab_size, dtype=torch.bool)
+        bpe_lut[list(self.bpe_toks)] = True
+        tokens = torch.LongTensor(tokens)
+        pos_scores = -torch.rand(len(tokens)) - 0.5
+        expected_scores, expected_skipped = self._old_merge(tokens, pos_scores)
+        merged_scores, skipped = merge_bpe_scores(tokens, pos_scores, bpe_lut)
+        self.assertLess((merged_scores - expected_scores).abs().max(), 1e-6)
+        self.assertEqual(int(skipped), expected_skipped)
+
+    def test_no_continuations(self):
+        self._check([1, 2, 3, 2])
+
+    def test_single_continuations(self):
+        self._check([4, 2, 3, 5, 1])
+
+    def test_consecutive_continuations(self):
+        self._check([4, 5, 4, 2, 5, 5, 3])
+
+    def test_continuation_at_the_start(self):
+        self._check([5, 4, 4, 1])
+
+    def test_continuation_at_the_end(self):
+        # the last token is never merged into a following one
+        self._check([1, 4, 5])
+        self._check([4, 4, 4, 4])
+
+    def test_short_sequences(self):
+        self._check([4])
+        self._check([4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ import unittest
 
 import torch
 
-from fairseq.sequence_scorer import SequenceScorer
+from fairseq.sequence_scorer import SequenceScorer, score_logits
 
 import tests.utils as test_utils
 
@@ -111,5 +111,52 @@ class TestSequenceScorer(unittest.TestCase):
         self.assertEqual(t1.ne(t2).long().sum(), 0)
 
 
+class TestScoreLogits(unittest.TestCase):
+
+    vocab_size = 11
+
+    def _check(self, shape, dtype, chunk_numel, k=5):
+        torch.manual_seed(0)
+        logits = (torch.randn(*shape, self.vocab_size) * 4).to(dtype)
+        target = torch.randint(0, self.vocab_size, shape)
+        lprobs = torch.log_softmax(logits.float(), dim=-1)
+
+        tgt_probs, topk_tokens = score_logits(logits, target, k, chunk_numel=chunk_numel)
+        self.assertEqual(tgt_probs.dtype, torch.float32)
+        self.assertEqual(tgt_probs.size(), target.unsqueeze(-1).size())
+        self.assertLess((tgt_probs - lprobs.gather(dim=2, index=target.unsqueeze(-1))).abs().max(), 1e-5)
+
+        if k == 0:
+            self.assertIsNone(topk_tokens)
+        else:
+            # compare the log probs of the top-k rather than the tokens, which
+            # are ambiguous for ties
+            expected, _ = torch.topk(lprobs, k=k, dim=-1)
+            self.assertEqual(topk_tokens.size(), expected.size())
+            self.assertLess((lprobs.gather(dim=2, index=topk_tokens) - expected).abs().max(), 1e-6)
+
+    def test_single_batch(self):
+        for dtype in [torch.float32, torch.float16]:
+            self._check((2, 5), dtype, chunk_numel=None)
+
+    def test_softmax_batches(self):
+        for dtype in [torch.float32, torch.float16]:
+            self._check((1, 10), dtype, chunk_numel=None)
+
+    def test_chunked_logsumexp(self):
+        # 3 rows per chunk, which does not divide the 10 rows
+        chunk_numel = 3 * self.vocab_size + 2
+        for dtype in [torch.float32, torch.float16]:
+            self._check((2, 5), dtype, chunk_numel=chunk_numel)
+            self._check((1, 10), dtype, chunk_numel=chunk_numel)
+
+    def test_chunk_smaller_than_a_row(self):
+        self._check((1, 10), torch.float16, chunk_numel=1)
+
+    def test_no_topk(self):
+        self._check((2, 5), torch.float32, chunk_numel=None, k=0)
+        self._check((1, 10), torch.float16, chunk_numel=3 * self.vocab_size, k=0)
+
+
 if __name__ == '__main__':
     unittest.main()